@@ -1,8 +1,11 @@
-import os
-import tempfile
-from pathlib import Path
-from typing import BinaryIO, Optional, cast
-
+import queue
+import statistics
+import threading
+from collections import Counter, defaultdict
+from itertools import groupby
+from typing import Optional, TypeAlias
+
+import numpy as np
 from pdfixsdk import (
     GetPdfix,
     PdfDoc,
@@ -22,9 +25,100 @@ from tqdm import tqdm
 from constants import EASY_OCR, RAPID_OCR, TESSERACT_OCR
 from exceptions import PdfixFailedToOpenException, PdfixFailedToSaveException, PdfixInitializeException
 from ocr import OCR
-from page_render import crop_image, render_page
+from page_render import crop_image, get_device_areas, render_bboxes, render_page
 from utils_sdk import authorize_sdk, get_latest_sdk_error
 
+# U+FFFE is 65534, U+FEFF is 65279
+MISSING_UNICODE_CODES: frozenset[int] = frozenset({0xFFFE, 0xFEFF})
+
+# How many locations of each glyph are OCR at most
+MAX_OCR_LOCATIONS: int = 5
+# How many items can wait between pipeline stages
+PIPELINE_QUEUE_SIZE: int = 64
+# How many cropped images are sent to OCR engine at once
+OCR_BATCH_SIZE: int = 32
+# Page is rendered with zoom that makes glyph this many pixels tall, same as OCR engines expect
+GLYPH_TARGET_HEIGHT: float = 64.0
+# Render zoom is kept between 72 and 600 DPI
+MIN_RENDER_ZOOM: float = 1.0
+MAX_RENDER_ZOOM: float = 600.0 / 72.0
+# Render zoom is rounded to multiples of 36 DPI so both OCR rounds render page with same zoom more often
+RENDER_ZOOM_STEP: float = 0.5
+# Page with at most this many locations is not rendered whole, only glyph areas are rendered
+BBOX_RENDER_MAX_LOCATIONS: int = 4
+
+# Missing glyph is identified by font handle and char code
+GlyphKey: TypeAlias = tuple[int, int]
+# Cropped image is identified by page render (page index, zoom) and rounded bbox
+CropKey: TypeAlias = tuple[tuple[int, float], tuple[int, int, int, int, int]]
+
+
+def get_bbox_key(page_index: int, bbox: PdfRect) -> tuple[int, int, int, int, int]:
+    """
+    Creates key identifying area on PDF page. Coordinates are rounded so same places give same keys.
+
+    Args:
+        page_index (int): Page index that area is on.
+        bbox (PdfRect): Bounding Box of area.
+
+    Returns:
+        Tuple of page index and rounded coordinates (left, top, right, bottom).
+    """
+    return (page_index, round(bbox.left), round(bbox.top), round(bbox.right), round(bbox.bottom))
+
+
+def get_render_zoom(glyph_height: float) -> float:
+    """
+    Calculates zoom for rendering page so that glyph of given height is as tall as OCR engines expect.
+
+    Args:
+        glyph_height (float): Height of glyph in points.
+
+    Returns:
+        Zoom rounded to render zoom step and clamped to allowed range.
+    """
+    zoom: float = GLYPH_TARGET_HEIGHT / max(1.0, glyph_height)
+    zoom = round(zoom / RENDER_ZOOM_STEP) * RENDER_ZOOM_STEP
+    return min(max(zoom, MIN_RENDER_ZOOM), MAX_RENDER_ZOOM)
+
+
+def get_page_render_zoom(locations: list["CharLocation"]) -> float:
+    """
+    Calculates zoom for rendering page once for all character locations on it. Smallest glyph needs biggest zoom,
+    bigger glyphs are just rendered taller. Locations with empty bbox (e.g. spaces) have nothing to render and do
+    not raise zoom of whole page.
+
+    Args:
+        locations (list[CharLocation]): Locations of characters on one page.
+
+    Returns:
+        Biggest zoom needed by any of locations.
+    """
+    return max(
+        (get_render_zoom(location.height) for location in locations if location.height > 0), default=MIN_RENDER_ZOOM
+    )
+
+
+def increase_bbox_coordinates(
+    left: float, top: float, right: float, bottom: float, increase_by: int
+) -> tuple[float, float, float, float]:
+    """
+    Increases bounding box coordinates by x points in each direction. Respects whether top is above bottom or not.
+
+    Args:
+        left (float): Left coordinate of original bounding box.
+        top (float): Top coordinate of original bounding box.
+        right (float): Right coordinate of original bounding box.
+        bottom (float): Bottom coordinate of original bounding box.
+        increase_by (int): How many points/pixel to add at each side.
+
+    Returns:
+        Increased coordinates (left, top, right, bottom).
+    """
+    if bottom < top:
+        return (left - increase_by, top + increase_by, right + increase_by, bottom - increase_by)
+    return (left - increase_by, top - increase_by, right + increase_by, bottom + increase_by)
+
 
 class CharLocation:
     """
@@ -33,7 +127,8 @@ class CharLocation:
 
     def __init__(self, page_index: int, bbox: PdfRect) -> None:
         """
-        Constructor for character location in PDF document. Calculate height of BBox of character.
+        Constructor for character location in PDF document. Calculate height of BBox of character and creates
+        unique key.
 
         Args:
             page_index (int): Page index that character is on.
@@ -42,6 +137,7 @@ class CharLocation:
         self.page_index: int = page_index
         self.bbox: PdfRect = bbox
         self.height: float = self._get_height()
+        self.key: tuple[int, int, int, int, int] = get_bbox_key(page_index, bbox)
 
     def _get_height(self) -> float:
         """
@@ -64,30 +160,38 @@ class MissingGlyph:
     Class containing all info about embedded font glyph that has missing unicode.
     """
 
-    def __init__(self, font: PdfFont, char_code: int) -> None:
+    def __init__(self, font: PdfFont, font_name: str, char_code: int) -> None:
         """
-        Constructor for missing glyph information. Creates unique key.
+        Constructor for missing glyph information. Creates unique key from font handle and char code, font name
+        is kept only for logging.
 
         Args:
             font (PdfFont): Embedded font that has missing glyph.
+            font_name (str): Name of embedded font.
             char_code (int): Code of missing glyph.
         """
         self.font: PdfFont = font
+        self.font_name: str = font_name
         self.char_code: int = char_code
         self.locations: list[CharLocation] = []
-        self.key: str = f"{font.GetFontName()}{char_code}"
+        self.location_keys: set[tuple[int, int, int, int, int]] = set()
+        self.key: GlyphKey = (font.obj, char_code)
 
     def add_location(self, location: CharLocation) -> None:
         """
-        Add location where font glyph is used in dokument.
+        Add location where font glyph is used in dokument. Same place is added only once.
 
         Args:
             location (CharLocation): All info about location.
         """
+        if location.key in self.location_keys:
+            return
+
+        self.location_keys.add(location.key)
         self.locations.append(location)
 
     def str(self) -> str:
-        output: str = f"Missing Glyph: Font: {self.font.GetFontName()}, Char Code: {self.char_code}\n  "
+        output: str = f"Missing Glyph: Font: {self.font_name}, Char Code: {self.char_code}\n  "
         output += "\n  ".join(location.str() for location in self.locations)
         return output
 
@@ -127,7 +231,12 @@ class FixFontGlyphsUnicodesPdfix:
         self.output_file_str_path: str = output_path
         self.engine: str = engine
         self.default_character: str = default_character
-        self.cached_renders: dict[int, Path] = {}
+        # Cropped images by render key and bbox key
+        self.cached_crops: dict[CropKey, np.ndarray] = {}
+        # Font name for embedded fonts, None for not embedded fonts, by font handle
+        self.cached_font_names: dict[int, Optional[str]] = {}
+        # Whether font already knows unicode of char code, by font handle and char code
+        self.cached_font_unicodes: dict[GlyphKey, bool] = {}
         # self.font_info: dict[str, tuple[PdfFont, set[int]]] = {}
 
     def fix_missing_unicode(self) -> None:
@@ -158,7 +267,7 @@ class FixFontGlyphsUnicodesPdfix:
                     progress_bar.refresh()
 
                     # Fix missing unicodes in the embedded fonts from the document
-                    missing_glyphs: dict[str, MissingGlyph] = self._gather_all_missing_occurences(
+                    missing_glyphs: dict[GlyphKey, MissingGlyph] = self._gather_all_missing_occurences(
                         pdfix, doc, progress_bar, 40
                     )
                     # self._debug_all_fonts_info(missing_glyphs)
@@ -173,8 +282,6 @@ class FixFontGlyphsUnicodesPdfix:
                     progress_bar.set_description("Saving document")
                     progress_bar.refresh()
 
-                    self._clean_up_rendered_pages()
-
                     # Save the processed document
                     if not doc.Save(self.output_file_str_path, kSaveFull):
                         raise PdfixFailedToSaveException(pdfix, self.output_file_str_path)
@@ -189,7 +296,7 @@ class FixFontGlyphsUnicodesPdfix:
 
     def _gather_all_missing_occurences(
         self, pdfix: Pdfix, doc: PdfDoc, progress_bar: tqdm, total_units: float
-    ) -> dict[str, MissingGlyph]:
+    ) -> dict[GlyphKey, MissingGlyph]:
         """
         Goes though text on all PDF pages of PDF document and gather all occurences where emebedded font is missing
         glyph unicode and at which places.
@@ -203,188 +310,446 @@ class FixFontGlyphsUnicodesPdfix:
         Returns:
             Dictionary containing all missing glyphs.
         """
-        missing_glyphs: dict[str, MissingGlyph] = {}
+        missing_glyphs: dict[GlyphKey, MissingGlyph] = {}
         page_count: int = doc.GetNumPages()
         step: float = float(page_count) / total_units
-
+        # Thread safety of one PDF document in PDFix SDK is not guaranteed so pages are scanned one by one
         for page_index in range(page_count):
-            page: Optional[PdfPage] = doc.AcquirePage(page_index)
+            for glyph_info, location in self._scan_page(pdfix, doc, page_index):
+                dictionary_key: GlyphKey = glyph_info.key
+                if dictionary_key not in missing_glyphs:
+                    missing_glyphs[dictionary_key] = glyph_info
 
-            if page is None:
-                sdk_error: str = get_latest_sdk_error(pdfix)
-                print(f"Failed to open page {page_index + 1}: {sdk_error}")
-                continue
+                missing_glyphs[dictionary_key].add_location(location)
 
-            try:
-                # Get Page Content
-                content: Optional[PdsContent] = page.GetContent()
+            progress_bar.update(step)
+
+        return missing_glyphs
+
+    def _scan_page(self, pdfix: Pdfix, doc: PdfDoc, page_index: int) -> list[tuple[MissingGlyph, CharLocation]]:
+        """
+        Goes though text on one PDF page and finds all occurences where emebedded font is missing glyph unicode.
+
+        Args:
+            pdfix (Pdfix): SDK to be able to call API.
+            doc (PdfDoc): Opened PDF document.
+            page_index (int): Which page to scan.
+
+        Returns:
+            List of missing glyphs and their locations on page.
+        """
+        occurences: list[tuple[MissingGlyph, CharLocation]] = []
+
+        page: Optional[PdfPage] = doc.AcquirePage(page_index)
+
+        if page is None:
+            sdk_error: str = get_latest_sdk_error(pdfix)
+            print(f"Failed to open page {page_index + 1}: {sdk_error}")
+            return occurences
+
+        try:
+            # Get Page Content
+            content: Optional[PdsContent] = page.GetContent()
+
+            if content is None:
+                sdk_error = get_latest_sdk_error(pdfix)
+                print(f"Failed to get content from PDF page: {sdk_error}")
+                return occurences
 
-                if content is None:
+            # Walk Objects in Content
+            num_objects: int = content.GetNumObjects()
+
+            for obj_index in range(num_objects):
+                obj: Optional[PdsPageObject] = content.GetObject(obj_index)
+
+                if obj is None:
                     sdk_error = get_latest_sdk_error(pdfix)
-                    print(f"Failed to get content from PDF page: {sdk_error}")
+                    print(f"Failed to obtain {obj_index + 1}. object: {sdk_error}")
                     continue
 
-                # Walk Objects in Content
-                num_objects: int = content.GetNumObjects()
-
-                for obj_index in range(num_objects):
-                    obj: Optional[PdsPageObject] = content.GetObject(obj_index)
+                # We are interested only in Text Objects
+                if obj.GetObjectType() == kPdsPageText:
+                    text: PdsText = PdsText(obj.obj)
+                    state: PdfTextState = text.GetTextState()
+                    font: Optional[PdfFont] = state.font
+                    if font is None:
+                        continue
 
-                    if obj is None:
-                        sdk_error = get_latest_sdk_error(pdfix)
-                        print(f"Failed to obtain {obj_index + 1}. object: {sdk_error}")
+                    font_name: Optional[str] = self._get_embedded_font_name(font)
+                    if font_name is None:
+                        # We are not interested in not embedded fonts
                         continue
 
-                    # We are interested only in Text Objects
-                    if obj.GetObjectType() == kPdsPageText:
-                        text: PdsText = PdsText(obj.obj)
-                        state: PdfTextState = text.GetTextState()
-                        font: Optional[PdfFont] = state.font
-                        if font is None or not font.GetEmbedded():
-                            # We are not interested in not embedded fonts
+                    # Find characters of text object without unicode. Character should be OCR when it is empty
+                    # or it is one of missing unicode characters. Long strings should not be OCR and aren't what
+                    # break clause 7.27.1
+                    num_chars: int = text.GetNumChars()
+                    chars: list[str] = [text.GetCharText(index) for index in range(num_chars)]
+                    missing_indexes: list[int] = [
+                        index
+                        for index, char in enumerate(chars)
+                        if not char or (len(char) == 1 and ord(char) in MISSING_UNICODE_CODES)
+                    ]
+
+                    # Walk only characters that should be OCR
+                    for char_index in missing_indexes:
+                        char_code: int = text.GetCharCode(char_index)
+                        if self._resolve_unicode_from_font(pdfix, font, char_code):
+                            # Font already knows the unicode, no need to OCR it
                             continue
 
-                        # Walk characters of text object
-                        num_chars: int = text.GetNumChars()
-
-                        for char_index in range(num_chars):
-                            char_code: int = text.GetCharCode(char_index)
-                            char_text: str = text.GetCharText(char_index)
-                            # self._add_info(font, char_code)
-                            if not self._should_char_be_ocr(char_text):
-                                # Glyph has unicode assigned, go to next character
-                                continue
-
-                            bbox: PdfRect = text.GetCharBBox(char_index)
-                            glyph_info: MissingGlyph = MissingGlyph(font, char_code)
-                            location: CharLocation = CharLocation(page_index, bbox)
-                            dictionary_key: str = glyph_info.key
-                            if dictionary_key not in missing_glyphs:
-                                missing_glyphs[dictionary_key] = glyph_info
-
-                            missing_glyphs[dictionary_key].add_location(location)
-            finally:
-                page.Release()
-
-            progress_bar.update(step)
+                        bbox: PdfRect = text.GetCharBBox(char_index)
+                        glyph_info: MissingGlyph = MissingGlyph(font, font_name, char_code)
+                        location: CharLocation = CharLocation(page_index, bbox)
+                        occurences.append((glyph_info, location))
+        finally:
+            page.Release()
 
-        return missing_glyphs
+        return occurences
 
-    def _should_char_be_ocr(self, character: str) -> bool:
+    def _get_embedded_font_name(self, font: PdfFont) -> Optional[str]:
         """
-        Decide if character should go to OCR engine.
+        Return name of embedded font. Either from cache or ask SDK and add it to cache.
 
         Args:
-            character (str): Character in question.
+            font (PdfFont): Font used by text object.
 
         Returns:
-            True if character should be OCR, False otherwise.
+            Font name if font is embedded, None otherwise.
         """
-        # number: int = ord(character) if character != "" else -1
-        # unicode_str: str = f"U+{ord(character):04X}" if number >= 0 else "-1"
+        if font.obj in self.cached_font_names:
+            return self.cached_font_names[font.obj]
 
-        # print(f"Found character: '{character}' number: {number} with unicode: {unicode_str}")
+        font_name: Optional[str] = font.GetFontName() if font.GetEmbedded() else None
+        self.cached_font_names[font.obj] = font_name
+        return font_name
 
-        if character == "":
-            return True
+    def _resolve_unicode_from_font(self, pdfix: Pdfix, font: PdfFont, char_code: int) -> bool:
+        """
+        Asks font for unicode of char code. Text extraction might miss unicode that font has. When font has valid
+        unicode it is assigned to char code directly. Result is cached per font and char code.
 
-        # Long strings should not be OCR and aren't what break clause 7.27.1
-        if len(character) != 1:
-            return False
+        Args:
+            pdfix (Pdfix): SDK to be able to call API.
+            font (PdfFont): Font used by text object.
+            char_code (int): Char code of glyph in font.
 
-        number: int = ord(character)
+        Returns:
+            True if font resolved unicode of char code, False if glyph needs OCR.
+        """
+        cache_key: GlyphKey = (font.obj, char_code)
+        if cache_key in self.cached_font_unicodes:
+            return self.cached_font_unicodes[cache_key]
 
-        # U+FFFE is 65534, U+FEFF is 65279
-        if number in {65534, 65279}:
-            return True
+        font_char: str = font.GetUnicodeFromCharcode(char_code)
+        resolved: bool = font_char != "" and not any(ord(char) in MISSING_UNICODE_CODES for char in font_char)
+        if resolved and not font.SetUnicodeForCharcode(char_code, font_char):
+            sdk_error: str = get_latest_sdk_error(pdfix)
+            print(f"Failed to set {font_char} to charcode {char_code}: {sdk_error}")
+            resolved = False
 
-        return False
+        self.cached_font_unicodes[cache_key] = resolved
+        return resolved
 
     def _process_all_missing_occurences(
-        self, pdfix: Pdfix, doc: PdfDoc, missing_glyphs: dict[str, MissingGlyph], progress_bar: tqdm, total_units: float
+        self,
+        pdfix: Pdfix,
+        doc: PdfDoc,
+        missing_glyphs: dict[GlyphKey, MissingGlyph],
+        progress_bar: tqdm,
+        total_units: float,
     ) -> None:
         """
         Go through all missing glyphs and for each makes couple of images and tries to OCR them. Also assigns all
         successfull OCRs.
 
+        First round OCRs only as many locations of each glyph as are needed for majority. Second round OCRs rest of
+        locations only for glyphs where first round results did not agree.
+
         Args:
             pdfix (Pdfix): Pdfix SDK.
             doc (PdfDoc): Opened PDF document.
-            missing_glyphs (dict[str, MissingGlyph]): Dictionary containing all missing glyphs for processing.
+            missing_glyphs (dict[GlyphKey, MissingGlyph]): All missing glyphs for processing.
             progress_bar (tqdm): Progress bar.
             total_units (float): Total units to fill in this section for progress bar.
         """
         ocr: OCR = OCR(self.default_character)
         step: float = float(len(missing_glyphs)) / total_units
+        majority: int = MAX_OCR_LOCATIONS // 2 + 1
+        votes: dict[GlyphKey, list[tuple[str, float]]] = {key: [] for key in missing_glyphs}
 
         for value in missing_glyphs.values():
-            locations: list[CharLocation] = value.locations
-            locations.sort(key=lambda x: x.height, reverse=True)
+            self._sort_locations(value.locations)
             # print(value.str())
-            new_char: str = self._ocr_missing_glyph(pdfix, doc, locations, ocr, value)
+
+        try:
+            first_round: list[tuple[GlyphKey, CharLocation]] = [
+                (glyph_key, location)
+                for glyph_key, value in missing_glyphs.items()
+                for location in value.locations[:majority]
+            ]
+            self._ocr_locations(pdfix, doc, first_round, ocr, votes)
+
+            second_round: list[tuple[GlyphKey, CharLocation]] = [
+                (glyph_key, location)
+                for glyph_key, value in missing_glyphs.items()
+                if not self._has_majority(votes[glyph_key], majority)
+                for location in value.locations[majority:MAX_OCR_LOCATIONS]
+            ]
+            self._ocr_locations(pdfix, doc, second_round, ocr, votes)
+        finally:
+            self.cached_crops.clear()
+
+        for glyph_key, value in missing_glyphs.items():
+            new_char: str = self._vote(value, votes[glyph_key])
             if not value.font.SetUnicodeForCharcode(value.char_code, new_char):
                 sdk_error = get_latest_sdk_error(pdfix)
                 print(f"Failed to set {new_char} to charcode {value.char_code}: {sdk_error}")
 
             progress_bar.update(step)
 
-    def _ocr_missing_glyph(
-        self, pdfix: Pdfix, doc: PdfDoc, locations: list[CharLocation], ocr: OCR, missing_glyph: MissingGlyph
-    ) -> str:
+    def _sort_locations(self, locations: list[CharLocation]) -> None:
+        """
+        Sort locations of glyph so typical renders go first. Locations closest to median height are preferred as
+        extreme heights may be noisy, bigger height wins when distance is same.
+
+        Args:
+            locations (list[CharLocation]): Locations of glyph, sorted in place.
+        """
+        if len(locations) == 0:
+            return
+
+        median_height: float = statistics.median(location.height for location in locations)
+        locations.sort(key=lambda x: (abs(x.height - median_height), -x.height))
+
+    def _has_majority(self, results: list[tuple[str, float]], majority: int) -> bool:
+        """
+        Decide if one character already has enough votes.
+
+        Args:
+            results (list[tuple[str, float]]): OCR results (character and score) of glyph.
+            majority (int): How many votes are needed.
+
+        Returns:
+            True if most recognised character has at least majority votes, False otherwise.
+        """
+        counts: Counter[str] = Counter(character for character, _ in results)
+        return len(counts) > 0 and counts.most_common(1)[0][1] >= majority
+
+    def _ocr_locations(
+        self,
+        pdfix: Pdfix,
+        doc: PdfDoc,
+        locations: list[tuple[GlyphKey, CharLocation]],
+        ocr: OCR,
+        votes: dict[GlyphKey, list[tuple[str, float]]],
+    ) -> None:
         """
-        Goes through top 5 (biggest height) locations of glyph in document and renders them, sends them to OCR, takes
-        most probable character value and returns it.
+        Renders, crops and OCRs all locations and adds results to votes of their glyphs.
+
+        Rendering with cropping and OCR run as two concurrent stages connected by bounded queue. Rendering stays in
+        calling thread as it is the only stage using PDFix SDK. Locations are processed page by page so each page is
+        rendered once and its render is freed as soon as its locations are cropped, only crops wait for OCR.
 
         Args:
             pdfix (Pdfix): Pdfix SDK.
             doc (PdfDoc): Opened PDF document.
-            locations (list[CharLocation]): List of locations of character.
-            ocr (OCR): OCR engines.
-            missing_glyph (MissingGlyph): Information about font and which character is being OCR.
+            locations (list[tuple[GlyphKey, CharLocation]]): Glyph keys and locations to OCR.
+            ocr (OCR): Initialized OCR engine.
+            votes (dict[GlyphKey, list[tuple[str, float]]]): OCR results of all glyphs, updated in place.
+        """
+        if len(locations) == 0:
+            return
+
+        locations = sorted(locations, key=lambda item: item[1].page_index)
+
+        ocr_queue: queue.Queue[Optional[tuple[GlyphKey, np.ndarray]]] = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        results_queue: queue.Queue[tuple[GlyphKey, tuple[str, float]]] = queue.Queue()
+        errors: list[BaseException] = []
+
+        ocr_thread: threading.Thread = threading.Thread(
+            target=self._ocr_stage, args=(ocr_queue, results_queue, ocr, errors)
+        )
+        ocr_thread.start()
+
+        try:
+            self._render_stage(pdfix, doc, locations, ocr_queue, errors)
+        finally:
+            # Sentinel shuts down the OCR stage
+            ocr_queue.put(None)
+            ocr_thread.join()
+
+        if len(errors) > 0:
+            raise errors[0]
+
+        while not results_queue.empty():
+            glyph_key, result = results_queue.get()
+            if result[0]:
+                votes[glyph_key].append(result)
+
+    def _render_stage(
+        self,
+        pdfix: Pdfix,
+        doc: PdfDoc,
+        locations: list[tuple[GlyphKey, CharLocation]],
+        ocr_queue: queue.Queue[Optional[tuple[GlyphKey, np.ndarray]]],
+        errors: list[BaseException],
+    ) -> None:
         """
-        max_count: int = 5
-        results: list[str] = []
-        count: int = 0
-        for location in locations:
-            count += 1
-            if count > max_count:
-                break
+        Goes through locations of glyphs grouped by page, renders each page once, crops areas of glyphs from it and
+        sends cropped images to OCR stage. Same area is cropped only once.
 
-            page: Optional[PdfPage] = doc.AcquirePage(location.page_index)
+        Args:
+            pdfix (Pdfix): Pdfix SDK.
+            doc (PdfDoc): Opened PDF document.
+            locations (list[tuple[GlyphKey, CharLocation]]): Glyph keys and locations to OCR sorted by page.
+            ocr_queue (queue.Queue): Queue for OCR stage.
+            errors (list[BaseException]): Exceptions raised by OCR stage.
+        """
+        for page_index, group in groupby(locations, key=lambda item: item[1].page_index):
+            if len(errors) > 0:
+                # Other stage failed, there is no point to continue
+                return
+
+            page_locations: list[tuple[GlyphKey, CharLocation]] = list(group)
+            # Page is rendered only once, with zoom that suits its smallest glyph
+            zoom: float = get_page_render_zoom([location for _, location in page_locations])
+            render_key: tuple[int, float] = (page_index, zoom)
+            page: Optional[PdfPage] = doc.AcquirePage(page_index)
 
             if page is None:
                 sdk_error: str = get_latest_sdk_error(pdfix)
-                print(f"Failed to open page {location.page_index + 1}: {sdk_error}")
+                print(f"Failed to open page {page_index + 1}: {sdk_error}")
                 continue
 
+            crop_keys: list[CropKey] = []
             try:
-                # Get page image
-                page_image: Path = self._get_pdf_page_render(pdfix, location.page_index, page)
-
-                with tempfile.NamedTemporaryFile(suffix=".jpg") as tmp:
-                    tmp_path: Path = Path(tmp.name)
+                new_bboxes: dict[CropKey, PdfRect] = {}
+                for _, location in page_locations:
                     bbox: PdfRect = self._increase_bbox(location.bbox, 2)
+                    crop_key: CropKey = (render_key, get_bbox_key(page_index, bbox))
+                    crop_keys.append(crop_key)
+                    if crop_key not in self.cached_crops:
+                        new_bboxes[crop_key] = bbox
+
+                crops: list[np.ndarray] = self._render_crops(pdfix, page, list(new_bboxes.values()), zoom)
+                self.cached_crops.update(zip(new_bboxes, crops))
+            finally:
+                page.Release()
 
-                    # Crop it
-                    crop_image(page_image, tmp_path, pdfix, page, bbox)
+            # # For debugging purposes save cut out to outside to study how the cut outs look like
+            # for crop_key in crop_keys:
+            #     local_file: Path = Path(f"/data/temp_image{crop_key}.jpg")
+            #     print(f"Save {crop_key} -> {local_file}")
+            #     Image.fromarray(self.cached_crops[crop_key]).save(local_file)  # for debugging
 
-                    # # For debugging purposes copy temporary image file to outside to study how the cut outs look like
-                    # local_file: Path = Path(f"/data/temp_image{tmp_path.stem}.jpg")
-                    # print(f"Copy {tmp_path} -> {local_file}")
-                    # shutil.copy(tmp_path, local_file)  # for debugging
+            for (glyph_key, _), crop_key in zip(page_locations, crop_keys):
+                ocr_queue.put((glyph_key, self.cached_crops[crop_key]))
 
-                    result: str = self._ocr_character(tmp_path, ocr)
+    def _render_crops(self, pdfix: Pdfix, page: PdfPage, bboxes: list[PdfRect], zoom: float) -> list[np.ndarray]:
+        """
+        Renders areas of bboxes on page and crops them. When only few areas are needed, just they are rendered,
+        otherwise whole page is rendered and areas are cropped from it. Page render is freed on return.
 
-                    if result:
-                        results.append(result)
-            finally:
-                page.Release()
+        Args:
+            pdfix (Pdfix): Pdfix SDK.
+            page (PdfPage): Opened PDF page.
+            bboxes (list[PdfRect]): Bounding boxes of areas to crop.
+            zoom (float): Zoom to render page with.
+
+        Returns:
+            Cropped images, in the same order as bboxes.
+        """
+        if len(bboxes) == 0:
+            return []
+
+        page_images: list[np.ndarray]
+        areas: list[tuple[float, float, float, float]]
+        if len(bboxes) <= BBOX_RENDER_MAX_LOCATIONS:
+            page_images = render_bboxes(pdfix, page, bboxes, zoom)
+            areas = [(0.0, 0.0, float(image.shape[1]), float(image.shape[0])) for image in page_images]
+        else:
+            page_images = [render_page(pdfix, page, zoom)] * len(bboxes)
+            areas = get_device_areas(pdfix, page, bboxes, zoom)
+
+        return [crop_image(page_image, area) for page_image, area in zip(page_images, areas)]
+
+    def _ocr_stage(
+        self,
+        ocr_queue: queue.Queue[Optional[tuple[GlyphKey, np.ndarray]]],
+        results_queue: queue.Queue[tuple[GlyphKey, tuple[str, float]]],
+        ocr: OCR,
+        errors: list[BaseException],
+    ) -> None:
+        """
+        Collects cropped images into batches and sends them to OCR engine. Runs until sentinel arrives.
 
+        Args:
+            ocr_queue (queue.Queue): Queue with glyph keys and cropped images.
+            results_queue (queue.Queue): Queue for glyph keys, recognised characters and their scores.
+            ocr (OCR): Initialized OCR engine.
+            errors (list[BaseException]): Place to store exception that stopped this stage.
+        """
+        batch: list[tuple[GlyphKey, np.ndarray]] = []
+
+        while (item := ocr_queue.get()) is not None:
+            if len(errors) > 0:
+                # Keep draining queue so rendering stage is not blocked
+                continue
+
+            batch.append(item)
+            if len(batch) >= OCR_BATCH_SIZE:
+                self._ocr_batch(batch, results_queue, ocr, errors)
+                batch = []
+
+        if len(errors) == 0 and len(batch) > 0:
+            self._ocr_batch(batch, results_queue, ocr, errors)
+
+    def _ocr_batch(
+        self,
+        batch: list[tuple[GlyphKey, np.ndarray]],
+        results_queue: queue.Queue[tuple[GlyphKey, tuple[str, float]]],
+        ocr: OCR,
+        errors: list[BaseException],
+    ) -> None:
+        """
+        Sends one batch of cropped images to OCR engine and puts results into results queue.
+
+        Args:
+            batch (list[tuple[GlyphKey, np.ndarray]]): Glyph keys and cropped images.
+            results_queue (queue.Queue): Queue for glyph keys, recognised characters and their scores.
+            ocr (OCR): Initialized OCR engine.
+            errors (list[BaseException]): Place to store exception that stopped this stage.
+        """
+        try:
+            results: list[tuple[str, float]] = self._ocr_characters([crop for _, crop in batch], ocr)
+            for (glyph_key, _), result in zip(batch, results):
+                results_queue.put((glyph_key, result))
+        except BaseException as e:
+            errors.append(e)
+
+    def _vote(self, missing_glyph: MissingGlyph, results: list[tuple[str, float]]) -> str:
+        """
+        Takes most probable character value from OCR results of all locations of glyph. Each result votes with its
+        score, ties (e.g. engines without scores) are broken by how many results agree.
+
+        Args:
+            missing_glyph (MissingGlyph): Information about font and which character is being OCR.
+            results (list[tuple[str, float]]): OCR results (character and score) of glyph.
+
+        Returns:
+            Chosen character or default character if OCR did not recognise anything.
+        """
         if len(results) == 0:
             return self.default_character
 
-        char_result: str = max(results, key=results.count)
-        font_name: str = missing_glyph.font.GetFontName()
+        scores: defaultdict[str, float] = defaultdict(float)
+        for character, score in results:
+            scores[character] += score
+        counts: Counter[str] = Counter(character for character, _ in results)
+
+        char_result: str = max(scores, key=lambda character: (scores[character], counts[character]))
+        font_name: str = missing_glyph.font_name
         char_code: int = missing_glyph.char_code
         # print(f"OCR Results: {results} -> {char_result} (Chosen character)")
         # print(f"Setting '{char_result}' to {font_name} char_code: {char_code}")
@@ -394,97 +759,48 @@ class FixFontGlyphsUnicodesPdfix:
         )
         return char_result
 
-    def _get_pdf_page_render(self, pdfix: Pdfix, page_index: int, page: PdfPage) -> Path:
-        """
-        Return path to rendered PDF Page. Either from cache or create it and add it to cache.
-
-        Args:
-            pdfix (Pdfix): Pdfix SDK.
-            page_index (int): Which page to render.
-            page (PdfPage): Opened PDF Page that will be rendered.
-
-        Returns:
-            Path to rendered image.
-        """
-        if page_index in self.cached_renders:
-            return self.cached_renders[page_index]
-
-        with tempfile.NamedTemporaryFile(suffix=".jpg", prefix=f"Page{page_index + 1}", delete=False) as tmp:
-            render_page(pdfix, page, cast(BinaryIO, tmp))
-            temp_path: Path = Path(tmp.name)
-            self.cached_renders[page_index] = temp_path
-            return temp_path
-
     def _increase_bbox(self, bbox: PdfRect, increase_by: int) -> PdfRect:
         """
-        Takes bbox from PDF page and increases it by x points in each direction.
+        Takes bbox from PDF page and creates new bbox increased by x points in each direction.
+        Original bbox is not changed.
 
         Args:
             bbox (PdfRect): Original bounding box.
             increase_by (int): How many points/pixel to add at each side.
 
         Returns:
-            Already increased bounding box.
+            New increased bounding box.
         """
-        if bbox.bottom < bbox.top:
-            bbox.left -= increase_by
-            bbox.right += increase_by
-            bbox.top += increase_by
-            bbox.bottom -= increase_by
-        else:
-            bbox.left -= increase_by
-            bbox.right += increase_by
-            bbox.top -= increase_by
-            bbox.bottom += increase_by
-        return bbox
+        increased: PdfRect = PdfRect()
+        increased.left, increased.top, increased.right, increased.bottom = increase_bbox_coordinates(
+            bbox.left, bbox.top, bbox.right, bbox.bottom, increase_by
+        )
+        return increased
 
-    def _ocr_character(self, image_path: Path, ocr: OCR) -> str:
+    def _ocr_characters(self, images: list[np.ndarray], ocr: OCR) -> list[tuple[str, float]]:
         """
-        Render cut of PDF page into temporary image file. Sends this file to OCR engine.
+        Sends all images to OCR engine in one batch.
 
         Args:
-            image_path (Path): Path to image file with character.
+            images (list[np.ndarray]): Image arrays with characters.
             ocr (OCR): Initialized OCR engine.
 
         Returns:
-            Character that OCR engine recognised.
+            Characters that OCR engine recognised and their scores, in the same order as images.
         """
-        result: str = ""
+        if len(images) == 0:
+            return []
+
+        results: list[tuple[str, float]] = [("", 0.0)] * len(images)
         match self.engine:
             case self.EASY_OCR:
-                result = ocr.easy_ocr(image_path)
+                results = ocr.easy_ocr_mosaic(images)
             case self.RAPID_OCR:
-                result = ocr.rapid_ocr(image_path)
+                results = ocr.rapid_ocr_batch(images)
             case self.TESSERACT_OCR:
-                result = ocr.tesseract_ocr(image_path)
+                results = ocr.tesseract_ocr_batch(images)
 
-        # Fallback does not bring more functionality so it will stay disabled
-        # if result == "":
-        #     print("FALLBACK")
-        #     # Fallback
-        #     tesseract_result: str = ocr.tesseract_ocr(image_path) if self.engine == self.TESSERACT_OCR else ""
-        #     easy_result: str = ocr.easy_ocr(image_path) if self.engine == self.EASY_OCR else ""
-        #     rapid_result: str = ocr.rapid_ocr(image_path) if self.engine == self.RAPID_OCR else ""
-        #     print(f"OCR: tesseract: '{tesseract_result}' easy: '{easy_result}' rapid: '{rapid_result}'")
-
-        #     if tesseract_result != "" and tesseract_result != " ":
-        #         print(f"Fallbacked from {self.engine} to Tesseract. New result: '{tesseract_result}'")
-        #         result = tesseract_result
-        #     elif easy_result != "" and easy_result != " ":
-        #         print(f"Fallbacked from {self.engine} to Easy. New result: '{easy_result}'")
-        #         result = easy_result
-        #     elif rapid_result != "" and rapid_result != " ":
-        #         print(f"Fallbacked from {self.engine} to Rapid. New result: '{rapid_result}'")
-        #         result = rapid_result
-
-        return result
-
-    def _clean_up_rendered_pages(self) -> None:
-        """
-        Removes all cached rendered PDF Pages.
-        """
-        for value in self.cached_renders.values():
-            os.remove(value)
+        return results
 
     # def _add_info(self, font: PdfFont, char_code: int) -> None:
     #     name: str = font.GetFontName()
@@ -494,7 +810,7 @@ class FixFontGlyphsUnicodesPdfix:
     #     else:
     #         self.font_info[name] = (font, {char_code})
 
-    # def _debug_all_fonts_info(self, missing_glyphs: dict[str, MissingGlyph]) -> None:
+    # def _debug_all_fonts_info(self, missing_glyphs: dict[GlyphKey, MissingGlyph]) -> None:
     #     for font_name, data in self.font_info.items():
     #         font: PdfFont = data[0]
     #         char_codes: set[int] = data[1]
@@ -1,10 +1,19 @@
+import math
+import os
+import queue
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
 from pathlib import Path
-from typing import Any
+from typing import TYPE_CHECKING, Any, Callable, Optional
 
-import easyocr
-import pytesseract
-from rapidocr_onnxruntime import RapidOCR
+import numpy as np
+from PIL import Image
+
+if TYPE_CHECKING:
+    import easyocr
+    from rapidocr_onnxruntime import RapidOCR
+    from tesserocr import PyTessBaseAPI
 
 # To filter out:
 # /usr/font-fix/venv/lib/python3.13/site-packages/torch/utils/data/dataloader.py:775:
@@ -13,120 +22,305 @@ from rapidocr_onnxruntime import RapidOCR
 #   super().__init__(loader)
 warnings.filterwarnings("ignore", message=".*pin_memory.*")
 
+# Batched Easy OCR resizes all character images to same size
+EASY_OCR_BATCH_SIZE: int = 32
+EASY_OCR_BATCH_WIDTH: int = 64
+EASY_OCR_BATCH_HEIGHT: int = 64
+# Mosaic of character images is OCR at once, tiles with lower confidence are OCR one by one
+EASY_OCR_MOSAIC_MIN_CONFIDENCE: float = 0.5
+EASY_OCR_MOSAIC_MIN_PADDING: int = 16
+# Rapid OCR results with lower score are total nonsense
+RAPID_OCR_MIN_SCORE: float = 0.1
+# How many Tesseract engines can run at once
+OCR_CONCURRENCY: int = os.cpu_count() or 1
+
 
 class OCR:
     """
-    Class that hold all OCR engines.
+    Class that hold all OCR engines. Engines are imported and loaded only when they are used for the first time.
     """
 
     def __init__(self, default_character: str) -> None:
         """
-        Initialize OCR engines
+        Initialize OCR engines configuration
 
         Args:
             default_character (str): Which character to use when OCR fails.
         """
         self.default_character: str = default_character
-        self.rapidocr: RapidOCR = RapidOCR()
+        self.easyocr_batch_ready: bool = False
+        # Tesseract engines are loaded once and reused, each can be used only by one thread at a time
+        self.tesseract_apis: queue.Queue["PyTessBaseAPI"] = queue.Queue()
+
+    @cached_property
+    def rapidocr(self) -> "RapidOCR":
+        """
+        Rapid OCR engine, loaded on first use.
+        """
+        from rapidocr_onnxruntime import RapidOCR
+
+        rapidocr: RapidOCR = RapidOCR()
+        # rapidocr.print_verbose = True # Debug info
+        rapidocr.text_score = RAPID_OCR_MIN_SCORE  # 0.0 debug Include everything
+        rapidocr.use_text_det = False  # Do not cut boxes with text as it is already cut of image
+        rapidocr.use_angle_cls = False  # Do not try to angle it
+        self._warm_up(rapidocr)
+        return rapidocr
+
+    @cached_property
+    def easyocr(self) -> "easyocr.Reader":
+        """
+        Easy OCR engine, loaded on first use.
+        """
+        import easyocr
+
         easy_ocr_models_folder: Path = Path(__file__).parent.parent.joinpath("easyocr_models").resolve()
         # As we are doing OCR over 1 character any advantage of using language words won't help us
         # so we ignore other languages https://github.com/JaidedAI/EasyOCR/tree/master/easyocr/character
-        self.easyocr: easyocr.Reader = easyocr.Reader(
+        reader: easyocr.Reader = easyocr.Reader(
             ["en"],
             gpu=False,
             verbose=False,
             download_enabled=False,
             model_storage_directory=easy_ocr_models_folder.as_posix(),
         )
+        self._warm_up(lambda dummy: reader.readtext(dummy, detail=0))
+        return reader
+
+    def _warm_up(self, run_ocr: Callable[[np.ndarray], Any]) -> None:
+        """
+        Run OCR engine once on empty image so lazy initialization does not happen during OCR of first character.
+        Warm up never fails, engines that fail here report errors during real OCR.
+
+        Args:
+            run_ocr (Callable[[np.ndarray], Any]): Runs OCR engine on image.
+        """
+        try:
+            run_ocr(np.zeros((32, 32, 3), dtype=np.uint8))
+        except Exception:
+            pass
 
-    def tesseract_ocr(self, path_to_image: Path) -> str:
+    def tesseract_ocr(self, image: np.ndarray) -> tuple[str, float]:
         """
         Use Tesseract OCR engine to find out what character is in image.
 
         Args:
-            path_to_image (Path): Path to image with character.
+            image (np.ndarray): RGB image array with character.
 
         Returns:
-            What character OCR found out.
+            What character OCR found out and its score (0.0 - 1.0).
         """
+        # Engine that can't be loaded would fail for every character, so its error is not hidden
+        tesseract_api: "PyTessBaseAPI" = self._acquire_tesseract_api()
         try:
-            # Using default language as we are doing OCR over 1 character
-            result: str = pytesseract.image_to_string(path_to_image.as_posix(), lang="eng", config="--psm 10")
+            tesseract_api.SetImage(Image.fromarray(image))
+            result: str = tesseract_api.GetUTF8Text()
+            # Confidence is in percents
+            score: float = max(tesseract_api.MeanTextConf(), 0) / 100.0
             # Remove new lines
             stripped_result: str = result.strip("\n")
             # Return first character
-            return stripped_result[0] if stripped_result != "" else ""
+            return (stripped_result[0], score) if stripped_result != "" else ("", 0.0)
         except Exception:
             print("During Tesseract OCR run, exception happened. Returning default result.")
-            return self.default_character
+            return (self.default_character, 0.0)
+        finally:
+            self.tesseract_apis.put(tesseract_api)
 
-    def rapid_ocr(self, path_to_image: Path) -> str:
+    def _acquire_tesseract_api(self) -> "PyTessBaseAPI":
         """
-        Use Rapid OCR engine to find out what character is in image.
+        Take loaded Tesseract engine that is not used by other thread or load new one.
+
+        Returns:
+            Tesseract engine that has to be returned to `tesseract_apis` after use.
+
+        Raises:
+            RuntimeError: When Tesseract can't be initialized, e.g. its language data are not found.
+        """
+        try:
+            return self.tesseract_apis.get_nowait()
+        except queue.Empty:
+            pass
+
+        from tesserocr import PSM, PyTessBaseAPI
+
+        # Using default language and single character mode (--psm 10) as we are doing OCR over 1 character
+        tesseract_api: PyTessBaseAPI = PyTessBaseAPI(lang="eng", psm=PSM.SINGLE_CHAR)
+
+        def run_ocr(image: np.ndarray) -> str:
+            tesseract_api.SetImage(Image.fromarray(image))
+            return tesseract_api.GetUTF8Text()
+
+        self._warm_up(run_ocr)
+        return tesseract_api
+
+    def tesseract_ocr_batch(self, images: list[np.ndarray]) -> list[tuple[str, float]]:
+        """
+        Use Tesseract OCR engine to find out what characters are in images. Tesseract engines run concurrently.
 
         Args:
-            path_to_image (Path): Path to image with character.
+            images (list[np.ndarray]): RGB image arrays with characters.
 
         Returns:
-            What character OCR found out.
+            What characters OCR found out and their scores, in the same order as images.
         """
-        try:
-            # Run OCR
-            # self.rapidocr.print_verbose = True # Debug info
-            self.rapidocr.text_score = 0.1  # 0.0 debug Include everything, 0.1 filter out total nonsence
-            self.rapidocr.use_text_det = False  # Do not cut boxes with text as it is already cut of image
-            self.rapidocr.use_angle_cls = False  # Do not try to angle it
-            result: Any = self.rapidocr(path_to_image.as_posix())
-
-            # Extract character from result
-            output: list[tuple[str, float]] = self._parse_rapid_ocr(result)
-            if len(output) > 0:
-                return max(output, key=lambda x: x[1])[0]
-
-            return self.default_character
-        except Exception:
-            print("During Rapid OCR run, exception happened. Returning default result.")
-            return self.default_character
+        with ThreadPoolExecutor(max_workers=OCR_CONCURRENCY) as executor:
+            return list(executor.map(self.tesseract_ocr, images))
 
-    def _parse_rapid_ocr(self, result: Any) -> list[tuple[str, float]]:
+    def rapid_ocr_batch(self, images: list[np.ndarray]) -> list[tuple[str, float]]:
         """
-        Parse results from Rapid OCR and return them as list of tuples.
+        Use Rapid OCR engine to find out what characters are in images. Images are sent to text recognition model
+        in batches.
 
         Args:
-            result (Any): Can be anything from Rapid OCR.
+            images (list[np.ndarray]): RGB image arrays with characters.
 
         Returns:
-            List of tuples with character and score. Can be empty list.
-        """
-        output: list[tuple[str, float]] = []
-        if isinstance(result, tuple):
-            # First are results, Second are times
-            first: Any = result[0]
-            if isinstance(first, list):
-                # Multiple results
-                for member in first:
-                    # Result is list containing 1 list (bbox) 2 str (recognised text) 3 float (score)
-                    if isinstance(member, list):
-                        recognised_text: str = str(member[1]) if len(member) > 1 else ""
-                        score: float = float(member[2]) if len(member) > 2 else 0.0
-                        output.append((recognised_text, score))
+            What characters OCR found out and their scores, in the same order as images.
+        """
+        output: list[tuple[str, float]] = [(self.default_character, 0.0)] * len(images)
+        # Recognition model can't resize empty images
+        indexes: list[int] = [index for index, image in enumerate(images) if image.size > 0]
+        if len(indexes) == 0:
+            return output
+
+        # Only recognition model is run, it returns results (text, score) and time it took
+        recognised: list[tuple[str, float]]
+        recognised, _ = self.rapidocr.text_recognizer([images[index] for index in indexes])
+        for index, (text, score) in zip(indexes, recognised):
+            # Engine score filter is not applied to recognition model alone
+            if text and float(score) >= RAPID_OCR_MIN_SCORE:
+                output[index] = (str(text), float(score))
         return output
 
-    def easy_ocr(self, path_to_image: Path) -> str:
+    def easy_ocr(self, image: np.ndarray) -> tuple[str, float]:
         """
         Use Easy OCR engine to find out what character is in image.
 
         Args:
-            path_to_image (Path): Path to image with character.
+            image (np.ndarray): RGB image array with character.
 
         Returns:
-            What character OCR found out.
+            What character OCR found out and its score.
         """
         try:
-            result: list[str] = self.easyocr.readtext(path_to_image.as_posix(), detail=0)
+            # Each result is tuple containing 1 list (bbox) 2 str (recognised text) 3 float (confidence)
+            result: list[tuple[Any, str, float]] = self.easyocr.readtext(image, detail=1)
             if len(result) > 0:
-                return result[0]
-            return self.default_character
+                return (result[0][1], float(result[0][2]))
+            return (self.default_character, 0.0)
         except Exception:
             print("During Easy OCR run, exception happened. Returning default result.")
-            return self.default_character
+            return (self.default_character, 0.0)
+
+    def easy_ocr_batch(self, images: list[np.ndarray]) -> list[tuple[str, float]]:
+        """
+        Use Easy OCR engine to find out what characters are in images. Images are resized to same size and sent to
+        model in batches.
+
+        Args:
+            images (list[np.ndarray]): RGB image arrays with characters.
+
+        Returns:
+            What characters OCR found out and their scores, in the same order as images.
+        """
+        try:
+            if not self.easyocr_batch_ready:
+                # Batched mode needs one warm up run to get the speed up
+                dummy: np.ndarray = np.zeros(
+                    (EASY_OCR_BATCH_SIZE, EASY_OCR_BATCH_HEIGHT, EASY_OCR_BATCH_WIDTH, 3), dtype=np.uint8
+                )
+                self.easyocr.readtext_batched(dummy, batch_size=EASY_OCR_BATCH_SIZE, detail=0)
+                self.easyocr_batch_ready = True
+
+            results: list[list[tuple[Any, str, float]]] = self.easyocr.readtext_batched(
+                images,
+                n_width=EASY_OCR_BATCH_WIDTH,
+                n_height=EASY_OCR_BATCH_HEIGHT,
+                batch_size=EASY_OCR_BATCH_SIZE,
+                detail=1,
+            )
+            return [
+                (result[0][1], float(result[0][2])) if len(result) > 0 else (self.default_character, 0.0)
+                for result in results
+            ]
+        except Exception:
+            print("During batched Easy OCR run, exception happened. Running OCR for each image.")
+            return [self.easy_ocr(image) for image in images]
+
+    def easy_ocr_mosaic(self, images: list[np.ndarray]) -> list[tuple[str, float]]:
+        """
+        Use Easy OCR engine to find out what characters are in images. Images are tiled into one mosaic image that
+        is OCR at once and results are mapped back to tiles. Tiles without confident result are OCR in batch.
+
+        Args:
+            images (list[np.ndarray]): RGB image arrays with characters.
+
+        Returns:
+            What characters OCR found out and their scores, in the same order as images.
+        """
+        results: list[Optional[tuple[str, float]]] = [None] * len(images)
+        # Engine that can't be loaded would fail for every character, so its error is not hidden
+        reader: "easyocr.Reader" = self.easyocr
+
+        try:
+            mosaic, tile_width, tile_height, columns = self._create_mosaic(images)
+            detections: list[tuple[Any, str, float]] = reader.readtext(mosaic, detail=1)
+
+            for bbox, text, confidence in detections:
+                # Tile is found by center of detected text
+                center_x: float = sum(float(point[0]) for point in bbox) / len(bbox)
+                center_y: float = sum(float(point[1]) for point in bbox) / len(bbox)
+                index: int = int(center_y // tile_height) * columns + int(center_x // tile_width)
+
+                if len(text) != 1 or index >= len(images) or images[index].size == 0:
+                    # Text spanning more tiles or detected outside of tiles
+                    continue
+
+                result: Optional[tuple[str, float]] = results[index]
+                if result is None or result[1] < float(confidence):
+                    results[index] = (text, float(confidence))
+        except Exception:
+            print("During mosaic Easy OCR run, exception happened. Running OCR in batch.")
+
+        fallback_indexes: list[int] = [
+            index
+            for index, result in enumerate(results)
+            if result is None or result[1] < EASY_OCR_MOSAIC_MIN_CONFIDENCE
+        ]
+        if len(fallback_indexes) > 0:
+            fallback_results: list[tuple[str, float]] = self.easy_ocr_batch(
+                [images[index] for index in fallback_indexes]
+            )
+            for index, fallback_result in zip(fallback_indexes, fallback_results):
+                results[index] = fallback_result
+
+        return [result if result is not None else (self.default_character, 0.0) for result in results]
+
+    def _create_mosaic(self, images: list[np.ndarray]) -> tuple[np.ndarray, int, int, int]:
+        """
+        Tile images into grid on white background. Each image is centered in tile with padding around it so
+        characters from neighbouring tiles are not detected as one text.
+
+        Args:
+            images (list[np.ndarray]): RGB image arrays with characters.
+
+        Returns:
+            Mosaic image array, tile width, tile height and number of columns.
+        """
+        max_height: int = max(image.shape[0] for image in images)
+        max_width: int = max(image.shape[1] for image in images)
+        padding: int = max(EASY_OCR_MOSAIC_MIN_PADDING, max(max_height, max_width) // 2)
+        tile_width: int = max_width + 2 * padding
+        tile_height: int = max_height + 2 * padding
+        columns: int = math.ceil(math.sqrt(len(images)))
+        rows: int = math.ceil(len(images) / columns)
+
+        mosaic: np.ndarray = np.full((rows * tile_height, columns * tile_width, 3), 255, dtype=np.uint8)
+        for index, image in enumerate(images):
+            height, width = image.shape[:2]
+            top: int = (index // columns) * tile_height + (tile_height - height) // 2
+            left: int = (index % columns) * tile_width + (tile_width - width) // 2
+            mosaic[top : top + height, left : left + width] = image
+
+        return mosaic, tile_width, tile_height, columns
@@ -1,100 +1,97 @@
-from pathlib import Path
-from typing import BinaryIO, Optional
+import ctypes
+from typing import Optional
 
+import numpy as np
 from pdfixsdk import (
     PdfDevRect,
-    PdfImageParams,
     Pdfix,
+    PdfMatrix,
     PdfPage,
     PdfPageRenderParams,
     PdfPageView,
     PdfRect,
-    PsFileStream,
     PsImage,
+    PsMemoryStream,
     kImageDIBFormatArgb,
-    kImageFormatJpg,
-    kPsTruncate,
     kRotate0,
 )
-from PIL import Image, ImageFile, ImageOps
+from PIL import Image
 
 from exceptions import PdfixFailedToRenderException
 
 ZOOM: float = 4.0
+# Grayscale value from which pixel is considered white
+MONOCHROME_THRESHOLD: int = 128
 
 
-def render_bbox(pdfix: Pdfix, page: PdfPage, bbox: PdfRect, temporary_file: BinaryIO) -> None:
+def render_bboxes(pdfix: Pdfix, page: PdfPage, bboxes: list[PdfRect], zoom: float = ZOOM) -> list[np.ndarray]:
     """
-    Render part of PDF document page to file.
+    Render several parts of PDF document page into memory. Page view is shared by all parts.
 
     Args:
         pdfix (Pdfix): Pdfix SDK.
         page (PdfPage): Opened PDF page.
-        bbox (PdfRect): The bounding box of the page to render.
-        temporary_file (BinaryIO): Temporary file for saving image.
+        bboxes (list[PdfRect]): The bounding boxes of the page to render.
+        zoom (float): Zoom of rendered parts, 1.0 is 72 DPI.
+
+    Returns:
+        Rendered parts of page as RGB image arrays (height, width, 3), in the same order as bboxes.
     """
-    page_view: Optional[PdfPageView] = page.AcquirePageView(ZOOM, kRotate0)
+    page_view: Optional[PdfPageView] = page.AcquirePageView(zoom, kRotate0)
     if page_view is None:
         raise PdfixFailedToRenderException(pdfix, "Unable to acquire page view")
 
     try:
-        rect: PdfDevRect = page_view.RectToDevice(bbox)
-
-        # Render bbox to image
-        render_parameters: PdfPageRenderParams = PdfPageRenderParams()
-        render_parameters.matrix = page_view.GetDeviceMatrix()
-        render_parameters.clip_box = bbox
-        ps_image: Optional[PsImage] = pdfix.CreateImage(
-            rect.right - rect.left,
-            rect.bottom - rect.top,
-            kImageDIBFormatArgb,
-        )
-        if ps_image is None:
-            raise PdfixFailedToRenderException(pdfix, "Unable to create the image")
-
-        render_parameters.image = ps_image
-
-        try:
-            if not page.DrawContent(render_parameters):
-                raise PdfixFailedToRenderException(pdfix, "Unable to draw the content")
-
-            # Save image to file
-            file_stream: Optional[PsFileStream] = pdfix.CreateFileStream(temporary_file.name, kPsTruncate)
-            if file_stream is None:
-                raise PdfixFailedToRenderException(pdfix, "Unable to create file stream")
+        images: list[np.ndarray] = []
+
+        for bbox in bboxes:
+            rect: PdfDevRect = page_view.RectToDevice(bbox)
+
+            # Render bbox to image, device matrix is moved so bbox starts at image origin
+            matrix: PdfMatrix = page_view.GetDeviceMatrix()
+            matrix.e -= rect.left
+            matrix.f -= rect.top
+            render_parameters: PdfPageRenderParams = PdfPageRenderParams()
+            render_parameters.matrix = matrix
+            render_parameters.clip_box = bbox
+            width: int = rect.right - rect.left
+            height: int = rect.bottom - rect.top
+            ps_image: Optional[PsImage] = pdfix.CreateImage(width, height, kImageDIBFormatArgb)
+            if ps_image is None:
+                raise PdfixFailedToRenderException(pdfix, "Unable to create the image")
+
+            render_parameters.image = ps_image
 
             try:
-                img_params: PdfImageParams = PdfImageParams()
-                img_params.format = kImageFormatJpg
-                img_params.quality = 100
+                if not page.DrawContent(render_parameters):
+                    raise PdfixFailedToRenderException(pdfix, "Unable to draw the content")
 
-                if not ps_image.SaveToStream(file_stream, img_params):
-                    raise PdfixFailedToRenderException(pdfix, "Unable to save image to stream")
+                images.append(_image_to_array(pdfix, ps_image, width, height))
             except Exception:
                 raise
             finally:
-                file_stream.Destroy()
-        except Exception:
-            raise
-        finally:
-            render_parameters.image.Destroy()
+                render_parameters.image.Destroy()
+
+        return images
     except Exception:
         raise
     finally:
         page_view.Release()
 
 
-def render_page(pdfix: Pdfix, page: PdfPage, temporary_file: BinaryIO) -> None:
+def render_page(pdfix: Pdfix, page: PdfPage, zoom: float = ZOOM) -> np.ndarray:
     """
-    Render part of PDF document page to file.
+    Render whole PDF document page into memory.
 
     Args:
         pdfix (Pdfix): Pdfix SDK.
         page (PdfPage): Opened PDF page.
-        bbox (PdfRect): The bounding box of the page to render.
-        temporary_file (BinaryIO): Temporary file for saving image.
+        zoom (float): Zoom of rendered page, 1.0 is 72 DPI.
+
+    Returns:
+        Rendered page as RGB image array (height, width, 3).
     """
-    page_view: Optional[PdfPageView] = page.AcquirePageView(ZOOM, kRotate0)
+    page_view: Optional[PdfPageView] = page.AcquirePageView(zoom, kRotate0)
     if page_view is None:
         raise PdfixFailedToRenderException(pdfix, "Unable to acquire page view")
 
@@ -103,7 +100,7 @@ def render_page(pdfix: Pdfix, page: PdfPage, temporary_file: BinaryIO) -> None:
         page_width = page_view.GetDeviceWidth()
         page_height = page_view.GetDeviceHeight()
 
-        # Render bbox to image
+        # Render page to image
         render_parameters: PdfPageRenderParams = PdfPageRenderParams()
         render_parameters.matrix = page_view.GetDeviceMatrix()
         ps_image: Optional[PsImage] = pdfix.CreateImage(page_width, page_height, kImageDIBFormatArgb)
@@ -116,22 +113,7 @@ def render_page(pdfix: Pdfix, page: PdfPage, temporary_file: BinaryIO) -> None:
             if not page.DrawContent(render_parameters):
                 raise PdfixFailedToRenderException(pdfix, "Unable to draw the content")
 
-            # Save image to file
-            file_stream: Optional[PsFileStream] = pdfix.CreateFileStream(temporary_file.name, kPsTruncate)
-            if file_stream is None:
-                raise PdfixFailedToRenderException(pdfix, "Unable to create file stream")
-
-            try:
-                img_params: PdfImageParams = PdfImageParams()
-                img_params.format = kImageFormatJpg
-                img_params.quality = 100
-
-                if not ps_image.SaveToStream(file_stream, img_params):
-                    raise PdfixFailedToRenderException(pdfix, "Unable to save image to stream")
-            except Exception:
-                raise
-            finally:
-                file_stream.Destroy()
+            return _image_to_array(pdfix, ps_image, page_width, page_height)
         except Exception:
             raise
         finally:
@@ -142,69 +124,124 @@ def render_page(pdfix: Pdfix, page: PdfPage, temporary_file: BinaryIO) -> None:
         page_view.Release()
 
 
-def crop_image(input_image: Path, output_image: Path, pdfix: Pdfix, page: PdfPage, bbox: PdfRect) -> None:
+def _image_to_array(pdfix: Pdfix, ps_image: PsImage, width: int, height: int) -> np.ndarray:
+    """
+    Read raw pixels of rendered image from memory as array. No image format is encoded or decoded.
+
+    Args:
+        pdfix (Pdfix): Pdfix SDK.
+        ps_image (PsImage): Image with drawn page content.
+        width (int): Width of image in pixels.
+        height (int): Height of image in pixels.
+
+    Returns:
+        RGB image array (height, width, 3).
     """
-    Crops input image according to bbox and puts it into output image.
+    memory_stream: Optional[PsMemoryStream] = pdfix.CreateMemStream()
+    if memory_stream is None:
+        raise PdfixFailedToRenderException(pdfix, "Unable to create memory stream")
+
+    try:
+        if not ps_image.SaveDataToStream(memory_stream):
+            raise PdfixFailedToRenderException(pdfix, "Unable to save image to stream")
+
+        # SDK reads stream into ctypes unsigned byte buffer
+        size: int = memory_stream.GetSize()
+        data: ctypes.Array[ctypes.c_ubyte] = (ctypes.c_ubyte * size)()
+        if not memory_stream.Read(0, data, size):
+            raise PdfixFailedToRenderException(pdfix, "Unable to read image from stream")
+
+        # Pixels are stored as BGRA, alpha is dropped and channels reversed
+        pixels: np.ndarray = np.frombuffer(memoryview(data), dtype=np.uint8).reshape(height, width, 4)
+        return pixels[:, :, 2::-1]
+    except Exception:
+        raise
+    finally:
+        memory_stream.Destroy()
+
+
+def get_device_areas(
+    pdfix: Pdfix, page: PdfPage, bboxes: list[PdfRect], zoom: float = ZOOM
+) -> list[tuple[float, float, float, float]]:
+    """
+    Converts bboxes inside PDF page into areas of rendered page image. Page view is shared by all bboxes.
 
     Args:
-        input_image (Path): Path to input image file.
-        output_image (Path): Path to output image file.
         pdfix (Pdfix): Pdfix SDK.
         page (PdfPage): Opened PDF page.
-        bbox (PdfRect): Bounding box inside that page.
+        bboxes (list[PdfRect]): Bounding boxes inside that page.
+        zoom (float): Zoom that page image was rendered with.
+
+    Returns:
+        Areas (left, top, right, bottom) in pixels of rendered page image, in the same order as bboxes.
     """
-    page_view: Optional[PdfPageView] = page.AcquirePageView(ZOOM, kRotate0)
+    page_view: Optional[PdfPageView] = page.AcquirePageView(zoom, kRotate0)
     if page_view is None:
         raise PdfixFailedToRenderException(pdfix, "Unable to acquire page view")
 
     try:
-        rect: PdfDevRect = page_view.RectToDevice(bbox)
-        image_file: ImageFile.ImageFile = Image.open(input_image)
-        area: tuple[float, float, float, float] = (rect.left, rect.top, rect.right, rect.bottom)
-        image: Image.Image = image_file.crop(area)
-        image.save(output_image, format="JPEG", quality=100, subsampling=0)
-
+        areas: list[tuple[float, float, float, float]] = []
+        for bbox in bboxes:
+            rect: PdfDevRect = page_view.RectToDevice(bbox)
+            areas.append((rect.left, rect.top, rect.right, rect.bottom))
+        return areas
     except Exception:
         raise
     finally:
         page_view.Release()
 
 
-def make_monochrome(image_path: Path) -> None:
+def crop_image(page_image: np.ndarray, area: tuple[float, float, float, float]) -> np.ndarray:
     """
-    Transform image into black and while image.
+    Crops rendered page image according to area. Area is clipped to image size.
 
     Args:
-        image_path (Path): Path to image file.
+        page_image (np.ndarray): Rendered page image array (height, width, 3).
+        area (tuple[float, float, float, float]): Area (left, top, right, bottom) in pixels of page image.
+
+    Returns:
+        Cropped image array.
     """
-    # Open the image
-    image: ImageFile.ImageFile = Image.open(image_path)
+    height, width = page_image.shape[:2]
+    left: int = min(max(round(min(area[0], area[2])), 0), width)
+    right: int = min(max(round(max(area[0], area[2])), 0), width)
+    top: int = min(max(round(min(area[1], area[3])), 0), height)
+    bottom: int = min(max(round(max(area[1], area[3])), 0), height)
+    # Copy so that crop does not keep whole page in memory
+    return page_image[top:bottom, left:right].copy()
+
+
+def make_monochrome(image: Image.Image) -> Image.Image:
+    """
+    Transform image into black and while image.
 
+    Args:
+        image (Image.Image): Image to transform.
+
+    Returns:
+        Bilevel image.
+    """
     # Convert to grayscale (L mode)
     grayscale: Image.Image = image.convert("L")
-    threshold: int = 128
-    black_white: Image.Image = grayscale.point(lambda x: 255 if x >= threshold else 0)
-    black_white = ImageOps.invert(black_white)
 
-    # Save the result
-    black_white.save(image_path, format="JPEG", quality=100, subsampling=0)
+    # Threshold and invert in one pass, pixels at or above threshold become black, 8 pixels are packed in byte
+    white: np.ndarray = np.asarray(grayscale, dtype=np.uint8) < MONOCHROME_THRESHOLD
+    packed: np.ndarray = np.packbits(white, axis=1)
+    return Image.frombytes("1", grayscale.size, packed.tobytes())
 
 
-def upscale(image_path: Path, scale: int) -> None:
+def upscale(image: Image.Image, scale: int) -> Image.Image:
     """
     Upscale image by scale factor.
 
     Args:
-        image_path (Path): Path to image file.
+        image (Image.Image): Image to upscale.
         scale (int): Multiplier for image size.
-    """
-    # Open the image
-    image_file: ImageFile.ImageFile = Image.open(image_path)
-
-    # Optional: upscale for better accuracy
-    image: Image.Image = image_file.resize(
-        (image_file.width * scale, image_file.height * scale), Image.Resampling.NEAREST
-    )
 
-    # Save the result
-    image.save(image_path, format="JPEG", quality=100, subsampling=0)
+    Returns:
+        Upscaled image.
+    """
+    # Nearest neighbour upscale by integer factor is only repeating of pixels
+    pixels: np.ndarray = np.asarray(image)
+    upscaled: np.ndarray = np.repeat(np.repeat(pixels, scale, axis=0), scale, axis=1)
+    return Image.fromarray(upscaled)
@@ -5,52 +5,59 @@ import hashlib
 import json
 import logging
 import os
+import re
 import shutil
 import subprocess
 import sys
 import tempfile
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import Any
+from typing import Any, Optional
 
 verbose: bool = len(sys.argv) > 2 and "-v" in sys.argv
 
 logger: logging.Logger = logging.getLogger("Testing Font Fixing")
 
-logger.setLevel(logging.DEBUG)
+# Logger itself has the level too, so messages that would not be shown are not even created
+level = logging.INFO if verbose else logging.WARNING
+logger.setLevel(level)
 
 console_handler: logging.StreamHandler = logging.StreamHandler()
-level = logging.INFO if verbose else logging.WARNING
 console_handler.setLevel(level)
 console_handler.setFormatter(logging.Formatter("%(message)s"))
 logger.addHandler(console_handler)
 
+# Text of first tag on line, e.g. '<td width="800">Xref streams shall not be used</td>'
+tag_text_pattern: re.Pattern[str] = re.compile(r">([^<]*)<")
+# Count of occurences, e.g. '<td width="800">1 occurrences'
+occurences_pattern: re.Pattern[str] = re.compile(r">\s*(\d+) occurrences")
+
 
 def get_list_of_pdfs(directory: Path) -> list[Path]:
     pdf_files: list[Path] = []
-    for path in directory.rglob("*.pdf"):
-        if path.is_file():
-            pdf_files.append(path)
+    # Directory entries know their type without extra stat calls
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                pdf_files.extend(get_list_of_pdfs(Path(entry.path)))
+            elif entry.name.endswith(".pdf") and entry.is_file():
+                pdf_files.append(Path(entry.path))
     return pdf_files
 
 
 def create_command_list(cli: str, temp_folder: Path, input_name: str, output_name: str) -> list[str]:
-    command_list: list[str] = cli.split(" ")
-
-    for index, cmd in enumerate(command_list):
-        if "${working_directory}" in cmd:
-            command_list[index] = cmd.replace("${working_directory}", str(temp_folder))
-        if "${input}" in cmd:
-            command_list[index] = cmd.replace("${input}", input_name)
-        if "${output}" in cmd:
-            command_list[index] = cmd.replace("${output}", output_name)
-
-    return command_list
+    # Placeholders in command are filled in one pass per argument
+    values: dict[str, str] = {"working_directory": str(temp_folder), "input": input_name, "output": output_name}
+    return [cmd.format_map(values) for cmd in cli.split(" ")]
 
 
 def run_command(command_list: list[str], cwd: Path) -> subprocess.CompletedProcess[str]:
-    logger.debug("Running command:")
-    for arg in command_list:
-        logger.debug(f"  Arg: {arg}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Running command:")
+        for arg in command_list:
+            logger.debug("  Arg: %s", arg)
     result: subprocess.CompletedProcess[str] = subprocess.run(
         command_list, cwd=cwd, capture_output=True, check=False, text=True
     )
@@ -58,19 +65,15 @@ def run_command(command_list: list[str], cwd: Path) -> subprocess.CompletedProce
     return result
 
 
-def clean_up(paths: list[Path]) -> None:
-    for path in paths:
-        if path.exists():
-            os.remove(path)
-
-
 def debug_print_directory_contents(directory: Path) -> None:
-    logger.debug(f"Contents of {directory}:")
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+
+    logger.debug("Contents of %s:", directory)
     logger.debug("- NAME - SIZE - RIGHTS")
     for path in directory.iterdir():
         stat_result: os.stat_result = path.stat()
-        stat_result.st_size
-        logger.debug(f"- {path.name} - {stat_result.st_size} - {oct(stat_result.st_mode)[-3:]}")
+        logger.debug("- %s - %s - %s", path.name, stat_result.st_size, oct(stat_result.st_mode)[-3:])
 
 
 def craft_process_message(result: subprocess.CompletedProcess[str], process_name: str, spaces: int = 2) -> str:
@@ -92,45 +95,47 @@ def add_spaces_to_each_line(text: str, spaces: int) -> str:
 def info_verification_message(
     input_verification: subprocess.CompletedProcess[str], output_verification: subprocess.CompletedProcess[str]
 ) -> None:
+    if not logger.isEnabledFor(logging.INFO):
+        return
+
     message: str = "  VERIFICATIONS:"
     message += craft_process_message(input_verification, "VERIFICATION INPUT")
     message += craft_process_message(output_verification, "VERIFICATION OUTPUT")
     logger.info(message)
 
 
-def get_accepted_return_codes(this_project_path: Path) -> list[int]:
-    config_json_path: Path = this_project_path.joinpath("config.json").resolve()
+@lru_cache(maxsize=None)
+def load_config(config_json_path: Path) -> dict[str, Any]:
+    # Config is parsed only once per path
     with open(config_json_path, "r", encoding="utf-8") as file:
         config_data: dict[str, Any] = json.load(file)
-        actions_data: list[dict[str, Any]] = config_data["actions"]
-        accepted_codes: list[int] = actions_data[0]["returnCodes"]
-        return accepted_codes
+        return config_data
+
+
+def get_accepted_return_codes(this_project_path: Path) -> list[int]:
+    config_json_path: Path = this_project_path.joinpath("config.json").resolve()
+    actions_data: list[dict[str, Any]] = load_config(config_json_path)["actions"]
+    accepted_codes: list[int] = actions_data[0]["returnCodes"]
+    return accepted_codes
 
 
 def copy_file(file_path: Path, folder_path: Path) -> None:
     destination_path: Path = folder_path.joinpath(file_path.name).resolve()
-    with (
-        open(file_path, "r", encoding="utf-8") as source_file,
-        open(destination_path, "w", encoding="utf-8") as destination_file,
-    ):
-        logger.debug(f"{file_path}:")
-        content: str = source_file.read()
-        logger.debug(content)
-        destination_file.write(content)
-
+    shutil.copyfile(file_path, destination_path)
     destination_path.chmod(0o666)
 
-    with open(destination_path, "r", encoding="utf-8") as destination_file:
-        logger.debug(f"{destination_path}:")
-        logger.debug(destination_file.read())
+    if logger.isEnabledFor(logging.DEBUG):
+        with open(destination_path, "r", encoding="utf-8") as destination_file:
+            logger.debug("%s -> %s:", file_path, destination_path)
+            logger.debug(destination_file.read())
 
 
-def extract_rules(html_page: list[str]) -> dict[str, tuple[str, int]]:
+def extract_rules(html_lines: Iterable[str]) -> dict[str, tuple[str, int]]:
     rules: dict[str, tuple[str, int]] = {}
     parse_rules: bool = False
     failed_message: str = ""
     occurences: int = -1
-    for line in html_page:
+    for line in html_lines:
         if not parse_rules and 'id="table3"' in line:
             parse_rules = True
             continue
@@ -140,20 +145,25 @@ def extract_rules(html_page: list[str]) -> dict[str, tuple[str, int]]:
                 # line example:
                 #                     <td width="800">Xref streams shall not be used</td>
                 # <td width="50"><b><font color="red"><b>Failed</b></font></b></td>
-                failed_message = line.split(">")[1].split("<")[0]
+                tag_text_match: Optional[re.Match[str]] = tag_text_pattern.search(line)
+                if tag_text_match is not None:
+                    failed_message = tag_text_match.group(1)
             if "occurrences" in line:
                 # line example:
                 #                     <td width="800">1 occurrences
-                occurences = int(line.split(">")[1].split(" ")[0])
+                occurences_match: Optional[re.Match[str]] = occurences_pattern.search(line)
+                if occurences_match is not None:
+                    occurences = int(occurences_match.group(1))
 
             if occurences > 0 and failed_message != "":
-                hash: str = hashlib.md5(failed_message.encode("utf-8")).hexdigest()
-                rules[hash] = (failed_message, occurences)
+                # Rules are deduplicated by their message
+                rules[failed_message] = (failed_message, occurences)
                 failed_message = ""
                 occurences = -1
 
             if "</table>" in line:
-                parse_rules = False
+                # Rest of report is not needed
+                break
 
     return rules
 
@@ -163,7 +173,7 @@ def craft_summary_of_verification(output_html: Path) -> str:
 
     try:
         with open(output_html, "r") as output_file:
-            output_rules: dict[str, tuple[str, int]] = extract_rules(output_file.readlines())
+            output_rules: dict[str, tuple[str, int]] = extract_rules(output_file)
     except Exception:
         return message
 
@@ -173,61 +183,55 @@ def craft_summary_of_verification(output_html: Path) -> str:
     return message
 
 
-# Get config
-image_name: str = "font-fix-pdfix:test"
-build_cli: str = "docker build -t font-fix-pdfix:test ."
-cli: str = "docker run --rm -v ${working_directory}:/data -w /data font-fix-pdfix:test"
-cli += " fix-missing-unicode -i /data/${input} -o /data/${output}"
-verification_cli: str = "docker run -v ${working_directory}:/data --rm pdfix/validate-pdf-verapdf:v0.4.10"
-verification_cli += " validate --format html --profile /data/font_profiles.xml"
-verification_cli += " --input /data/${input} --output /data/${output}"
+def get_file_hash(file_path: Path) -> str:
+    with open(file_path, "rb") as file:
+        return hashlib.file_digest(file, "sha256").hexdigest()
 
-# Check .env
-test_folder: Path = Path(__file__).parent
-this_project_path: Path = test_folder.parent
-example_path: Path = this_project_path.joinpath("examples")
-projects_path: Path = this_project_path.parent
-error_output_folder: Path = test_folder.joinpath("output")
-error_output_folder.mkdir(exist_ok=True)
-accepted_return_codes: list[int] = [0]
 
-# Build docker image for testing
-build_result: subprocess.CompletedProcess[str] = run_command(build_cli.split(" "), this_project_path)
+def get_verification_cache_path(input_pdf_path: Path) -> Path:
+    # Fixed PDF gets new ID on every save so it can't be the key. Same input fixed by same image with same command
+    # and verified by same verifier with same profile gives same result
+    key_source: str = f"{image_id}\n{cli}\n{verification_image}\n{profile_hash}\n{get_file_hash(input_pdf_path)}"
+    key: str = hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+    return verification_cache_folder.joinpath(f"{key}.json")
 
-if build_result.returncode != 0:
-    logger.error("Failed to build docker image.")
-    logger.debug(craft_process_message(build_result, "BUILD DOCKER IMAGE"))
-    sys.exit(1)
 
-# Go through files
-count: int = 0
-passed: int = 0
-failed: list[str] = []
+def load_cached_verification(cache_path: Path) -> Optional[tuple[bool, str]]:
+    try:
+        with open(cache_path, "r", encoding="utf-8") as cache_file:
+            cached: dict[str, Any] = json.load(cache_file)
+            return cached["is_passed"], cached["summary"]
+    except Exception:
+        return None
 
-# Create temp directory
-with tempfile.TemporaryDirectory() as temp_dir:
-    temp_folder: Path = Path(temp_dir).resolve()
 
-    # Copy profile
-    profile_path: Path = test_folder.joinpath("font_profiles.xml").resolve()
-    if profile_path.exists():
-        copy_file(profile_path, temp_folder)
+def save_cached_verification(cache_path: Path, is_passed: bool, summary: str) -> None:
+    with open(cache_path, "w", encoding="utf-8") as cache_file:
+        json.dump({"is_passed": is_passed, "summary": summary}, cache_file)
 
-    # For each file:
-    for pdf_path in get_list_of_pdfs(example_path):
-        logger.debug(f"Processing {pdf_path}:")
-        count += 1
 
-        # if count > 50:
-        #     break
+def process_pdf(pdf_path: Path) -> tuple[str, bool]:
+    logger.debug("Processing %s:", pdf_path)
+
+    # Each PDF has its own temp directory so parallel docker runs don't collide
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_folder: Path = Path(temp_dir).resolve()
+
+        # Copy profile
+        if profile_path.exists():
+            copy_file(profile_path, temp_folder)
 
         # Copy input + make output name
         temp_input: Path = temp_folder.joinpath(pdf_path.name).resolve()
-        shutil.copy(pdf_path, temp_input)
+        try:
+            # Input is only read, hardlink avoids copying whole file
+            os.link(pdf_path, temp_input)
+        except OSError:
+            # Different file system or links not supported
+            shutil.copy(pdf_path, temp_input)
 
         # Fill commands
         output_pdf_name: str = f"{pdf_path.stem}_fixed.pdf"
-        output_pdf_path: Path = temp_folder.joinpath(output_pdf_name).resolve()
         command_list: list[str] = create_command_list(cli, temp_folder, pdf_path.name, output_pdf_name)
 
         output_html_name: str = f"{pdf_path.stem}_fixed_verified.html"
@@ -236,43 +240,104 @@ with tempfile.TemporaryDirectory() as temp_dir:
             verification_cli, temp_folder, output_pdf_name, output_html_name
         )
 
-        files_to_remove: list[Path] = [output_html_path, output_pdf_path, temp_input]
-
         # Run Fix
         cli_result: subprocess.CompletedProcess[str] = run_command(command_list, temp_folder)
 
         if cli_result.returncode == 0:
-            logger.debug(f"{pdf_path.name}: Command ran successfully ({cli_result.returncode}).")
+            logger.debug("%s: Command ran successfully (%s).", pdf_path.name, cli_result.returncode)
         else:
-            message: str = f"Check: {pdf_path.as_posix()}{craft_process_message(cli_result, 'COMMAND')}"
             logger.warning(f"❌ {pdf_path.name}: Failed command ({cli_result.returncode}). No verification run.")
-            logger.info(message)
-            failed.append(pdf_path.name)
-            clean_up(files_to_remove)
-            continue
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Check: %s%s", pdf_path.as_posix(), craft_process_message(cli_result, "COMMAND"))
+            return pdf_path.name, False
 
-        # Run verifications
-        verification_output_result: subprocess.CompletedProcess[str] = run_command(
-            verification_output_list, temp_folder
-        )
-        logger.debug(f"{pdf_path.name}: Verification on output ran {verification_output_result.returncode}.")
+        # Run verifications, unless same output was already verified
+        cache_path: Path = get_verification_cache_path(pdf_path)
+        cached_verification: Optional[tuple[bool, str]] = load_cached_verification(cache_path)
 
-        # Print results
-        is_passed = verification_output_result.returncode == 0
+        if cached_verification is not None:
+            logger.debug("%s: Verification on output taken from cache.", pdf_path.name)
+            is_passed, summary = cached_verification
+        else:
+            verification_output_result: subprocess.CompletedProcess[str] = run_command(
+                verification_output_list, temp_folder
+            )
+            logger.debug("%s: Verification on output ran %s.", pdf_path.name, verification_output_result.returncode)
+
+            is_passed = verification_output_result.returncode == 0
+            summary = "" if is_passed else craft_summary_of_verification(output_html_path)
+            if is_passed or output_html_path.exists():
+                # Verifier that did not produce report may have failed for other reasons, don't remember it
+                save_cached_verification(cache_path, is_passed, summary)
 
+        # Print results
         if is_passed:
             logger.warning(f"✅ {pdf_path.name}: Passed ({cli_result.returncode}).")
         else:
-            summary: str = craft_summary_of_verification(output_html_path)
             logger.warning(f"❌ {pdf_path.name}: Command ({cli_result.returncode}). Failed verification. {summary}")
-            failed.append(pdf_path.name)
-            clean_up(files_to_remove)
-            continue
 
-        passed += 1
+        return pdf_path.name, is_passed
+
 
-        # Clean-up
-        clean_up(files_to_remove)
+# Get config
+image_name: str = "font-fix-pdfix:test"
+build_cli: str = "docker build -t font-fix-pdfix:test ."
+cli: str = "docker run --rm -v {working_directory}:/data -w /data font-fix-pdfix:test"
+cli += " fix-missing-unicode -i /data/{input} -o /data/{output}"
+verification_image: str = "pdfix/validate-pdf-verapdf:v0.4.10"
+verification_cli: str = f"docker run -v {{working_directory}}:/data --rm {verification_image}"
+verification_cli += " validate --format html --profile /data/font_profiles.xml"
+verification_cli += " --input /data/{input} --output /data/{output}"
+
+# Check .env
+test_folder: Path = Path(__file__).parent
+this_project_path: Path = test_folder.parent
+example_path: Path = this_project_path.joinpath("examples")
+projects_path: Path = this_project_path.parent
+error_output_folder: Path = test_folder.joinpath("output")
+error_output_folder.mkdir(exist_ok=True)
+accepted_return_codes: list[int] = [0]
+profile_path: Path = test_folder.joinpath("font_profiles.xml").resolve()
+profile_hash: str = get_file_hash(profile_path) if profile_path.exists() else ""
+verification_cache_folder: Path = test_folder.joinpath(".verify-cache")
+verification_cache_folder.mkdir(exist_ok=True)
+# Each container runs its own OCR threads, so only a few containers run at once
+test_workers: int = min(4, os.cpu_count() or 1)
+
+# Build docker image for testing
+build_result: subprocess.CompletedProcess[str] = run_command(build_cli.split(" "), this_project_path)
+
+if build_result.returncode != 0:
+    logger.error("Failed to build docker image.")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(craft_process_message(build_result, "BUILD DOCKER IMAGE"))
+    sys.exit(1)
+
+# Image ID changes whenever rebuild changes the image
+image_id_result: subprocess.CompletedProcess[str] = run_command(
+    ["docker", "image", "inspect", "-f", "{{.Id}}", image_name], this_project_path
+)
+if image_id_result.returncode != 0:
+    logger.error("Failed to inspect docker image.")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(craft_process_message(image_id_result, "INSPECT DOCKER IMAGE"))
+    sys.exit(1)
+image_id: str = image_id_result.stdout.strip()
+
+# Go through files
+count: int = 0
+passed: int = 0
+failed: list[str] = []
+
+# Docker runs are independent, each worker mostly waits for its container
+with ThreadPoolExecutor(max_workers=test_workers) as executor:
+    for pdf_name, is_passed in executor.map(process_pdf, get_list_of_pdfs(example_path)):
+        count += 1
+
+        if is_passed:
+            passed += 1
+        else:
+            failed.append(pdf_name)
 
-    logger.error(f"Statistics {passed}/{count} (passed/total)")
-    logger.error(f"Failed files:\n{'\n'.join(failed)}")
+logger.error(f"Statistics {passed}/{count} (passed/total)")
+logger.error(f"Failed files:\n{'\n'.join(failed)}")